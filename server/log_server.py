@@ -6,21 +6,258 @@ Supports compression and efficient batching
 """
 
 import http.server
-import socketserver
+import collections
 import json
-import gzip
+import os
+import queue
+import signal
 import sys
+import threading
 from datetime import datetime
 from pathlib import Path
 
+from server_common import (
+    BACKEND_TIMEOUT, DEFAULT_WORKERS, SHUTDOWN_GRACE, KeepAliveMixin,
+    RequestTracker, fork_workers, read_into_buffer, stop_workers,
+)
+
+try:
+    import orjson
+except ImportError:  # optional - falls back to the stdlib json module
+    orjson = None
+
+try:
+    from isal import isal_zlib as zlib
+except ImportError:  # optional - ISA-L accelerated drop-in for zlib
+    import zlib
+
 # Default port for log server
 LOG_PORT = 8001
 
+# Worker processes serving the log port
+LOG_WORKERS = DEFAULT_WORKERS
+
 # Log storage directory
 LOG_DIR = Path(__file__).parent / 'logs'
 LOG_DIR.mkdir(exist_ok=True)
 
-class LogRequestHandler(http.server.BaseHTTPRequestHandler):
+# Chunk size used when streaming compressed request bodies
+READ_BUFFER_SIZE = 32 * 1024
+
+# Queued log batches are committed to disk at least this often (seconds);
+# every POST that arrives within one interval shares a single sync
+FLUSH_INTERVAL = 0.01
+
+# How long a request waits for its batch to be committed (seconds). Kept well
+# under the proxy's backend timeout, so the proxy never gives up first and has
+# the client retry a batch that is still committed
+COMMIT_TIMEOUT = BACKEND_TIMEOUT / 2
+
+# fdatasync skips the metadata flush fsync does (not available on macOS)
+_sync = getattr(os, 'fdatasync', os.fsync)
+
+# Flush early once this many bytes are waiting in the queue
+FLUSH_THRESHOLD = 1 << 20
+
+# CORS preflight response, sent verbatim
+_OPTIONS_RESPONSE = (
+    b'HTTP/1.1 200 OK\r\n'
+    b'Access-Control-Allow-Origin: *\r\n'
+    b'Access-Control-Allow-Methods: POST, OPTIONS\r\n'
+    b'Access-Control-Allow-Headers: Content-Type, Content-Encoding\r\n'
+    b'Content-Length: 0\r\n'
+    b'\r\n'
+)
+
+# Maximum number of log files kept open between flushes
+MAX_OPEN_FILES = 64
+
+# device_id becomes part of a file name, so it can't contain these
+_INVALID_DEVICE_ID_CHARS = frozenset('/\\\0')
+
+class _GroupCommit:
+    """Signalled once every batch queued in one flush interval is on disk"""
+    
+    def __init__(self):
+        self.done = threading.Event()
+        # log_file -> exception for files that could not be written
+        self.errors = {}
+
+# (device_id, log_file, data) tuples waiting for the flusher thread
+_LOG_QUEUE = collections.deque()
+_QUEUE_LOCK = threading.Lock()
+_FLUSH_EVENT = threading.Event()
+_queued_bytes = 0
+_pending_commit = _GroupCommit()
+
+# POST requests in progress, which shutdown waits for
+_ACTIVE_REQUESTS = RequestTracker()
+
+# Batches of log entries waiting to be echoed to the console
+_CONSOLE_QUEUE = queue.SimpleQueue()
+
+# device_id -> (log_file, open file), least recently used first
+_FILE_CACHE = collections.OrderedDict()
+_FILE_CACHE_LOCK = threading.Lock()
+
+def _json_loads(data):
+    """Parse JSON from UTF-8 bytes (uses orjson when available)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(bytes(data))
+
+def _json_dumps(obj):
+    """Serialize to compact UTF-8 JSON bytes (uses orjson when available)"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+# Health check response - the status never changes, so render it once
+_HEALTH_BODY = _json_dumps({
+    'status': 'ok',
+    'service': 'vlinder-log-server',
+    'port': LOG_PORT,
+})
+_HEALTH_RESPONSE = (
+    b'HTTP/1.1 200 OK\r\n'
+    b'Content-Type: application/json\r\n'
+    b'Content-Length: ' + str(len(_HEALTH_BODY)).encode() + b'\r\n'
+    b'\r\n' + _HEALTH_BODY
+)
+
+def _format_log_batch(device_id, logs, timestamp):
+    """Render a batch of log entries as newline-delimited JSON bytes"""
+    # device_id is the same for every entry, so its JSON is rendered once and
+    # spliced in as the closing part of each line
+    suffix = b',"device_id":' + _json_dumps(device_id) + b'}\n'
+    parts = []
+    append = parts.append
+    for log_entry in logs:
+        get = log_entry.get
+        append(_json_dumps({
+            'timestamp': get('timestamp', timestamp),
+            'level': get('level', 'DEBUG'),
+            'component': get('component', ''),
+            'message': get('message', ''),
+        })[:-1])
+        append(suffix)
+    return b''.join(parts)
+
+def _enqueue_log_batch(device_id, log_file, data):
+    """Queue a serialized batch for the flusher thread
+    
+    Returns the _GroupCommit that is signalled once the batch is on disk.
+    """
+    global _queued_bytes
+    with _QUEUE_LOCK:
+        _LOG_QUEUE.append((device_id, log_file, data))
+        _queued_bytes += len(data)
+        if _queued_bytes >= FLUSH_THRESHOLD:
+            _FLUSH_EVENT.set()
+        return _pending_commit
+
+def _get_log_file(device_id, log_file):
+    """Return an open append handle for the device's current log file
+    
+    Must be called with _FILE_CACHE_LOCK held.
+    """
+    cached = _FILE_CACHE.get(device_id)
+    if cached is not None:
+        cached_path, f = cached
+        if cached_path == log_file:
+            _FILE_CACHE.move_to_end(device_id)
+            return f
+        # Day rolled over - rotate to the new file
+        del _FILE_CACHE[device_id]
+        f.close()
+    
+    f = open(log_file, 'ab', buffering=1 << 16)
+    _FILE_CACHE[device_id] = (log_file, f)
+    
+    # Evict the least recently used handle
+    if len(_FILE_CACHE) > MAX_OPEN_FILES:
+        _, (_, oldest) = _FILE_CACHE.popitem(last=False)
+        oldest.close()
+    return f
+
+def _close_log_files():
+    """Flush and close all cached log file handles"""
+    with _FILE_CACHE_LOCK:
+        while _FILE_CACHE:
+            _, (_, f) = _FILE_CACHE.popitem()
+            f.close()
+
+def _drain_log_queue():
+    """Write out all queued batches and sync them as one group commit"""
+    global _queued_bytes, _pending_commit
+    with _QUEUE_LOCK:
+        pending = list(_LOG_QUEUE)
+        _LOG_QUEUE.clear()
+        _queued_bytes = 0
+        commit, _pending_commit = _pending_commit, _GroupCommit()
+    
+    # Group by file (device + day) so each file gets one write per flush
+    grouped = {}
+    for device_id, log_file, data in pending:
+        grouped.setdefault((device_id, log_file), []).append(data)
+    
+    try:
+        with _FILE_CACHE_LOCK:
+            for (device_id, log_file), chunks in grouped.items():
+                # A failing file only fails the requests that wrote to it
+                try:
+                    f = _get_log_file(device_id, log_file)
+                    f.write(b''.join(chunks))
+                    f.flush()
+                    _sync(f.fileno())
+                except Exception as e:
+                    commit.errors[log_file] = e
+                    # Drop the handle so the next flush reopens the file: its
+                    # buffer may still hold this batch, and after a failed sync
+                    # the fd can't vouch for earlier writes either
+                    cached = _FILE_CACHE.pop(device_id, None)
+                    if cached is not None:
+                        try:
+                            # Closing the raw file discards the buffered bytes
+                            # instead of flushing them on close
+                            cached[1].raw.close()
+                            cached[1].close()
+                        except OSError:
+                            pass
+    finally:
+        # Release every request waiting on this commit
+        commit.done.set()
+
+def _flusher():
+    """Background thread that drains the log queue to disk"""
+    while True:
+        _FLUSH_EVENT.wait(timeout=FLUSH_INTERVAL)
+        _FLUSH_EVENT.clear()
+        try:
+            _drain_log_queue()
+        except Exception as e:
+            print(f"[LogServer] Error writing logs: {e}", file=sys.stderr)
+
+def _console_writer():
+    """Background thread that echoes received logs to the console"""
+    while True:
+        logs = _CONSOLE_QUEUE.get()
+        lines = []
+        # Take everything that queued up meanwhile and print it in one write
+        while True:
+            for log_entry in logs:
+                component = log_entry.get('component', '')
+                message = log_entry.get('message', '')
+                level = log_entry.get('level', 'DEBUG')
+                lines.append(f"[{level}] [{component}] {message}\n")
+            try:
+                logs = _CONSOLE_QUEUE.get_nowait()
+            except queue.Empty:
+                break
+        sys.stdout.write(''.join(lines))
+        sys.stdout.flush()
+
+class LogRequestHandler(KeepAliveMixin, http.server.BaseHTTPRequestHandler):
     """HTTP request handler for receiving debug logs"""
     
     def log_message(self, format, *args):
@@ -31,9 +268,13 @@ class LogRequestHandler(http.server.BaseHTTPRequestHandler):
         """Handle POST requests with batched logs"""
         # Route to /logs endpoint
         if self.path == '/logs' or self.path == '/':
-            self._handle_logs()
+            with _ACTIVE_REQUESTS:
+                self._handle_logs()
         else:
             self.send_response(404)
+            # Request body is left unread, so the connection can't be reused
+            self.send_header('Connection', 'close')
+            self.send_header('Content-Length', '0')
             self.end_headers()
     
     def _handle_logs(self):
@@ -45,21 +286,19 @@ class LogRequestHandler(http.server.BaseHTTPRequestHandler):
             
             if content_length == 0:
                 self.send_response(400)
+                self.send_header('Content-Length', '0')
                 self.end_headers()
                 return
             
-            body = self.rfile.read(content_length)
+            body = self._read_body(content_length, content_encoding)
             
-            # Decompress if gzipped
-            if content_encoding == 'gzip':
-                body = gzip.decompress(body)
-            
-            # Parse JSON
+            # Parse JSON (orjson.JSONDecodeError subclasses json.JSONDecodeError)
             try:
-                log_data = json.loads(body.decode('utf-8'))
+                log_data = _json_loads(body)
             except json.JSONDecodeError as e:
                 print(f"[LogServer] Invalid JSON: {e}", file=sys.stderr)
                 self.send_response(400)
+                self.send_header('Content-Length', '0')
                 self.end_headers()
                 return
             
@@ -68,61 +307,89 @@ class LogRequestHandler(http.server.BaseHTTPRequestHandler):
             logs = log_data.get('logs', [])
             timestamp = datetime.now().isoformat()
             
+            if not _INVALID_DEVICE_ID_CHARS.isdisjoint(str(device_id)):
+                print(f"[LogServer] Invalid device_id: {device_id!r}", file=sys.stderr)
+                self.send_response(400)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            
             # Write to file (one file per device per day)
             log_file = LOG_DIR / f"{device_id}_{datetime.now().strftime('%Y%m%d')}.log"
             
-            with open(log_file, 'a', encoding='utf-8') as f:
-                for log_entry in logs:
-                    log_line = json.dumps({
-                        'timestamp': log_entry.get('timestamp', timestamp),
-                        'level': log_entry.get('level', 'DEBUG'),
-                        'component': log_entry.get('component', ''),
-                        'message': log_entry.get('message', ''),
-                        'device_id': device_id,
-                    }, ensure_ascii=False)
-                    f.write(log_line + '\n')
+            # Build the whole batch up front so it lands in a single write()
+            data = _format_log_batch(device_id, logs, timestamp)
             
-            # Also print to console for real-time viewing
-            for log_entry in logs:
-                component = log_entry.get('component', '')
-                message = log_entry.get('message', '')
-                level = log_entry.get('level', 'DEBUG')
-                print(f"[{level}] [{component}] {message}")
+            # Hand off to the flusher thread, which writes and syncs it together
+            # with every other batch that arrives in the same interval
+            commit = _enqueue_log_batch(device_id, log_file, data)
+            
+            # Also print to console for real-time viewing (off the request thread)
+            _CONSOLE_QUEUE.put(logs)
+            
+            # Only acknowledge once the batch is on stable storage
+            if not commit.done.wait(COMMIT_TIMEOUT):
+                raise TimeoutError("Timed out waiting for logs to be written")
+            error = commit.errors.get(log_file)
+            if error is not None:
+                raise OSError(f"Failed to write logs: {error}")
             
             # Send success response
+            response = _json_dumps({'status': 'ok', 'received': len(logs)})
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(response)))
             self.send_header('Access-Control-Allow-Origin', '*')
             self.end_headers()
-            self.wfile.write(json.dumps({'status': 'ok', 'received': len(logs)}).encode())
+            self.wfile.write(response)
             
         except Exception as e:
             print(f"[LogServer] Error processing logs: {e}", file=sys.stderr)
+            response = _json_dumps({'status': 'error', 'message': str(e)})
             self.send_response(500)
+            # Body may be partially read - don't reuse the connection
+            self.send_header('Connection', 'close')
+            self.send_header('Content-Length', str(len(response)))
             self.end_headers()
-            self.wfile.write(json.dumps({'status': 'error', 'message': str(e)}).encode())
+            self.wfile.write(response)
+    
+    def _read_body(self, content_length, content_encoding):
+        """Read the request body, inflating gzip content as it streams in"""
+        if content_encoding != 'gzip':
+            return read_into_buffer(self.rfile, content_length)
+        
+        # wbits=31 expects a gzip header and trailer
+        decompressor = zlib.decompressobj(wbits=31)
+        chunks = []
+        remaining = content_length
+        while remaining > 0:
+            chunk = read_into_buffer(self.rfile, min(READ_BUFFER_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            while True:
+                chunks.append(decompressor.decompress(chunk))
+                if not decompressor.unused_data:
+                    break
+                # Concatenated gzip members - decode the next one as well
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(wbits=31)
+        chunks.append(decompressor.flush())
+        if not decompressor.eof:
+            raise EOFError("Compressed body ended before the end-of-stream marker")
+        return b''.join(chunks)
     
     def do_OPTIONS(self):
         """Handle CORS preflight requests"""
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Content-Encoding')
-        self.end_headers()
+        self.wfile.write(_OPTIONS_RESPONSE)
     
     def do_GET(self):
         """Handle GET requests - return server status"""
         if self.path == '/health' or self.path == '/':
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({
-                'status': 'ok',
-                'service': 'vlinder-log-server',
-                'port': LOG_PORT,
-            }).encode())
+            self.wfile.write(_HEALTH_RESPONSE)
         else:
             self.send_response(404)
+            self.send_header('Content-Length', '0')
             self.end_headers()
 
 def main():
@@ -130,18 +397,43 @@ def main():
     # Ensure log directory exists
     LOG_DIR.mkdir(exist_ok=True)
     
-    # Create server
-    with socketserver.TCPServer(("", LOG_PORT), LogRequestHandler) as httpd:
+    # Shut down cleanly on kill as well as Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
+    # Create server (one thread per connection)
+    with http.server.ThreadingHTTPServer(("", LOG_PORT), LogRequestHandler) as httpd:
         print(f"Vlinder Log Server")
         print(f"==================")
         print(f"Listening on: http://localhost:{LOG_PORT}")
         print(f"Log directory: {LOG_DIR}")
+        print(f"Worker processes: {LOG_WORKERS}")
         print(f"\nPress Ctrl+C to stop the server")
         
+        children = fork_workers(LOG_WORKERS)
+        
+        # Start background log writer and console echo (in every process)
+        threading.Thread(target=_flusher, name='log-flusher', daemon=True).start()
+        threading.Thread(target=_console_writer, name='log-console', daemon=True).start()
+        
         try:
             httpd.serve_forever()
-        except KeyboardInterrupt:
-            print("\n\nLog server stopped.")
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            # Don't let another signal interrupt the shutdown below
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            if children:
+                stop_workers(children)
+            
+            # Let requests in progress be committed and answered, then write
+            # out anything still queued
+            _ACTIVE_REQUESTS.wait_idle(SHUTDOWN_GRACE)
+            _drain_log_queue()
+            _close_log_files()
+            if children is None:
+                os._exit(0)
+        print("\n\nLog server stopped.")
 
 if __name__ == '__main__':
     main()
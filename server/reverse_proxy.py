@@ -4,21 +4,124 @@ Reverse proxy router for Vlinder services
 Routes requests to asset server and log server based on path
 """
 
+import http.client
 import http.server
-import socketserver
-import urllib.request
+import os
+import signal
 import urllib.parse
 import sys
-from http.client import HTTPResponse
+import threading
+
+from server_common import (
+    BACKEND_TIMEOUT, DEFAULT_WORKERS, SHUTDOWN_GRACE, KeepAliveMixin,
+    RequestTracker, fork_workers, read_into_buffer, stop_workers,
+)
 
 # Port for reverse proxy (public-facing)
 PROXY_PORT = 8000
 
+# Worker processes serving the proxy port
+PROXY_WORKERS = DEFAULT_WORKERS
+
 # Backend service URLs
 ASSET_SERVER_URL = 'http://localhost:8002'
 LOG_SERVER_URL = 'http://localhost:8001'
 
-class ReverseProxyHandler(http.server.BaseHTTPRequestHandler):
+# Path prefixes routed to the log server, by method (everything else goes
+# to the asset server)
+_LOG_SERVER_ROUTES = {
+    'GET': ('/health',),
+    'POST': ('/logs',),
+}
+
+# CORS preflight response, sent verbatim
+_OPTIONS_RESPONSE = (
+    b'HTTP/1.1 200 OK\r\n'
+    b'Access-Control-Allow-Origin: *\r\n'
+    b'Access-Control-Allow-Methods: GET, POST, OPTIONS\r\n'
+    b'Access-Control-Allow-Headers: Content-Type, Content-Encoding\r\n'
+    b'Content-Length: 0\r\n'
+    b'\r\n'
+)
+
+# Request headers not forwarded to backends, and backend response headers
+# not relayed to clients (the proxy sets its own framing)
+_EXCLUDED_REQUEST_HEADERS = frozenset({'host', 'connection', 'content-length'})
+_EXCLUDED_RESPONSE_HEADERS = frozenset({'connection', 'content-length', 'transfer-encoding'})
+
+# Backend response bodies up to this size are read in one go; larger ones
+# are streamed to the client through a reusable per-thread buffer
+COPY_BUFFER_SIZE = 64 * 1024
+_COPY_BUFFERS = threading.local()
+
+# Maximum idle keep-alive connections kept per backend
+MAX_POOL_SIZE = 32
+
+# Backend host:port -> idle connections ready for reuse
+_POOLS = {}
+_POOL_LOCK = threading.Lock()
+
+# Proxied requests in progress, which shutdown waits for
+_ACTIVE_REQUESTS = RequestTracker()
+
+def _backend_for(method, path):
+    """Return the base URL of the backend that handles a request"""
+    prefixes = _LOG_SERVER_ROUTES.get(method)
+    if prefixes and path.startswith(prefixes):
+        return LOG_SERVER_URL
+    return ASSET_SERVER_URL
+
+def _checkout_connection(netloc):
+    """Return (connection, reused) for a backend, preferring an idle one"""
+    with _POOL_LOCK:
+        idle = _POOLS.get(netloc)
+        if idle:
+            return idle.pop(), True
+    return http.client.HTTPConnection(netloc, timeout=BACKEND_TIMEOUT), False
+
+def _checkin_connection(netloc, conn):
+    """Return a connection to the pool, closing it if the pool is full"""
+    with _POOL_LOCK:
+        idle = _POOLS.setdefault(netloc, [])
+        if len(idle) < MAX_POOL_SIZE:
+            idle.append(conn)
+            return
+    conn.close()
+
+def _backend_request(netloc, method, path, body=None, headers=()):
+    """Send a request to a backend over a pooled connection
+    
+    headers is a sequence of (name, value) pairs. Returns (connection,
+    response) with the response body still unread; hand both to
+    _release_connection once the body has been consumed.
+    """
+    conn, reused = _checkout_connection(netloc)
+    while True:
+        try:
+            # Host is added by putrequest; everything else is sent as given
+            conn.putrequest(method, path, skip_accept_encoding=True)
+            for header, value in headers:
+                conn.putheader(header, value)
+            conn.endheaders(body)
+            return conn, conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            conn.close()
+            if not reused:
+                raise
+            # Backend dropped the idle connection - retry once on a fresh one
+            conn, reused = http.client.HTTPConnection(netloc, timeout=BACKEND_TIMEOUT), False
+        except Exception:
+            conn.close()
+            raise
+
+def _release_connection(netloc, conn, response):
+    """Pool the connection if its response was fully read, else close it"""
+    if response.will_close or not response.isclosed():
+        conn.close()
+    else:
+        _checkin_connection(netloc, conn)
+
+class ReverseProxyHandler(KeepAliveMixin, http.server.BaseHTTPRequestHandler):
     """HTTP request handler that proxies requests to backend services"""
     
     def log_message(self, format, *args):
@@ -27,114 +130,133 @@ class ReverseProxyHandler(http.server.BaseHTTPRequestHandler):
     
     def _proxy_request(self, target_url, method='GET', body=None, headers=None):
         """Proxy a request to a backend service"""
-        try:
-            # Parse target URL
-            parsed_url = urllib.parse.urlparse(target_url)
-            
-            # Prepare request
-            req = urllib.request.Request(target_url, data=body, method=method)
-            
-            # Copy headers from original request (excluding host and connection)
-            if headers:
-                for header, value in headers.items():
-                    if header.lower() not in ['host', 'connection', 'content-length']:
-                        req.add_header(header, value)
-            
-            # Add content-length if body exists
-            if body:
-                req.add_header('Content-Length', str(len(body)))
-            
-            # Make request to backend
-            with urllib.request.urlopen(req, timeout=10) as response:
-                # Read response
-                response_data = response.read()
+        with _ACTIVE_REQUESTS:
+            headers_sent = False
+            try:
+                # Split target URL into backend address and request path
+                parsed_url = urllib.parse.urlsplit(target_url)
+                path = parsed_url.path or '/'
+                if parsed_url.query:
+                    path += '?' + parsed_url.query
                 
-                # Send response back to client
-                self.send_response(response.status)
+                # Copy headers from original request (excluding host and connection)
+                forward_headers = []
+                if headers:
+                    for header, value in headers.items():
+                        if header.lower() not in _EXCLUDED_REQUEST_HEADERS:
+                            forward_headers.append((header, value))
                 
-                # Copy response headers (excluding connection)
-                for header, value in response.headers.items():
-                    if header.lower() != 'connection':
-                        self.send_header(header, value)
+                # Add content-length if body exists
+                if body:
+                    forward_headers.append(('Content-Length', str(len(body))))
                 
-                # Add CORS headers
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-                self.send_header('Access-Control-Allow-Headers', 'Content-Type, Content-Encoding')
+                # Make request to backend
+                conn, response = _backend_request(
+                    parsed_url.netloc, method, path, body=body, headers=forward_headers)
                 
-                self.end_headers()
-                self.wfile.write(response_data)
+                try:
+                    # Send response back to client (backend errors are passed through as-is)
+                    self.send_response(response.status)
+                    
+                    # Copy response headers (framing headers are set below)
+                    for header, value in response.getheaders():
+                        if header.lower() not in _EXCLUDED_RESPONSE_HEADERS:
+                            self.send_header(header, value)
+                    
+                    # Stream large bodies; read small or unknown-length ones whole
+                    if response.length is None or response.length <= COPY_BUFFER_SIZE:
+                        response_data = response.read()
+                    else:
+                        response_data = None
+                    if response.status in (204, 304):
+                        pass  # No body, and no Content-Length to describe one
+                    elif response_data is None:
+                        self.send_header('Content-Length', str(response.length))
+                    else:
+                        self.send_header('Content-Length', str(len(response_data)))
+                    
+                    # Add CORS headers
+                    self.send_header('Access-Control-Allow-Origin', '*')
+                    self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+                    self.send_header('Access-Control-Allow-Headers', 'Content-Type, Content-Encoding')
+                    
+                    self.end_headers()
+                    headers_sent = True
+                    if response_data is None:
+                        self._copy_response_body(response)
+                    elif response_data:
+                        self.wfile.write(response_data)
+                finally:
+                    _release_connection(parsed_url.netloc, conn, response)
                 
-        except urllib.error.HTTPError as e:
-            # Handle HTTP errors
-            self.send_response(e.code)
-            self.send_header('Content-Type', 'text/plain')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(f"Proxy error: {e.reason}".encode())
-        except Exception as e:
-            # Handle other errors
-            print(f"[ReverseProxy] Error proxying request: {e}", file=sys.stderr)
-            self.send_response(500)
-            self.send_header('Content-Type', 'text/plain')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(f"Proxy error: {str(e)}".encode())
+            except Exception as e:
+                # Handle connection errors and timeouts
+                print(f"[ReverseProxy] Error proxying request: {e}", file=sys.stderr)
+                if headers_sent:
+                    # Too late for an error response - drop the client connection
+                    self.close_connection = True
+                    return
+                message = f"Proxy error: {str(e)}".encode()
+                self.send_response(500)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(message)))
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+                self.wfile.write(message)
+        
+    def _copy_response_body(self, response):
+        """Stream a backend response body to the client in fixed-size chunks"""
+        buffer = getattr(_COPY_BUFFERS, 'buffer', None)
+        if buffer is None:
+            buffer = _COPY_BUFFERS.buffer = bytearray(COPY_BUFFER_SIZE)
+        view = memoryview(buffer)
+        while True:
+            n = response.readinto(buffer)
+            if not n:
+                break
+            self.wfile.write(view[:n])
     
     def do_GET(self):
         """Handle GET requests"""
-        # Route /logs/health and /health to log server
-        if self.path == '/health' or self.path.startswith('/health'):
-            target_url = f"{LOG_SERVER_URL}{self.path}"
-            self._proxy_request(target_url, method='GET', headers=dict(self.headers))
-        else:
-            # Route everything else to asset server
-            target_url = f"{ASSET_SERVER_URL}{self.path}"
-            self._proxy_request(target_url, method='GET', headers=dict(self.headers))
+        # Route /health to log server, everything else to asset server
+        target_url = f"{_backend_for('GET', self.path)}{self.path}"
+        self._proxy_request(target_url, method='GET', headers=self.headers)
     
     def do_POST(self):
         """Handle POST requests"""
-        # Route /logs to log server
-        if self.path == '/logs' or self.path.startswith('/logs'):
-            # Read request body
-            content_length = int(self.headers.get('Content-Length', 0))
-            body = self.rfile.read(content_length) if content_length > 0 else None
-            
-            target_url = f"{LOG_SERVER_URL}{self.path}"
-            self._proxy_request(target_url, method='POST', body=body, headers=dict(self.headers))
-        else:
-            # Route everything else to asset server
-            content_length = int(self.headers.get('Content-Length', 0))
-            body = self.rfile.read(content_length) if content_length > 0 else None
-            
-            target_url = f"{ASSET_SERVER_URL}{self.path}"
-            self._proxy_request(target_url, method='POST', body=body, headers=dict(self.headers))
+        # Read request body
+        content_length = int(self.headers.get('Content-Length', 0))
+        body = read_into_buffer(self.rfile, content_length) if content_length > 0 else None
+        
+        # Route /logs to log server, everything else to asset server
+        target_url = f"{_backend_for('POST', self.path)}{self.path}"
+        self._proxy_request(target_url, method='POST', body=body, headers=self.headers)
     
     def do_OPTIONS(self):
         """Handle OPTIONS requests for CORS preflight"""
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Content-Encoding')
-        self.end_headers()
+        self.log_request(200)
+        self.wfile.write(_OPTIONS_RESPONSE)
     
     def do_PUT(self):
         """Handle PUT requests (proxy to asset server)"""
         content_length = int(self.headers.get('Content-Length', 0))
-        body = self.rfile.read(content_length) if content_length > 0 else None
+        body = read_into_buffer(self.rfile, content_length) if content_length > 0 else None
         
         target_url = f"{ASSET_SERVER_URL}{self.path}"
-        self._proxy_request(target_url, method='PUT', body=body, headers=dict(self.headers))
+        self._proxy_request(target_url, method='PUT', body=body, headers=self.headers)
     
     def do_DELETE(self):
         """Handle DELETE requests (proxy to asset server)"""
         target_url = f"{ASSET_SERVER_URL}{self.path}"
-        self._proxy_request(target_url, method='DELETE', headers=dict(self.headers))
+        self._proxy_request(target_url, method='DELETE', headers=self.headers)
 
 def main():
     """Start the reverse proxy server"""
-    # Create server
-    with socketserver.TCPServer(("", PROXY_PORT), ReverseProxyHandler) as httpd:
+    # Shut down cleanly on kill as well as Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
+    # Create server (one thread per connection)
+    with http.server.ThreadingHTTPServer(("", PROXY_PORT), ReverseProxyHandler) as httpd:
         print(f"Vlinder Reverse Proxy Router")
         print(f"============================")
         print(f"Listening on: http://localhost:{PROXY_PORT}")
@@ -143,12 +265,27 @@ def main():
         print(f"\nRouting:")
         print(f"  /logs, /health → Log Server ({LOG_SERVER_URL})")
         print(f"  /* → Asset Server ({ASSET_SERVER_URL})")
+        print(f"Worker processes: {PROXY_WORKERS}")
         print(f"\nPress Ctrl+C to stop the server")
         
+        children = fork_workers(PROXY_WORKERS)
+        
         try:
             httpd.serve_forever()
-        except KeyboardInterrupt:
-            print("\n\nReverse proxy stopped.")
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            # Don't let another signal interrupt the shutdown below
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            if children:
+                stop_workers(children)
+            
+            # Let requests in progress get their response
+            _ACTIVE_REQUESTS.wait_idle(SHUTDOWN_GRACE)
+            if children is None:
+                os._exit(0)
+        print("\n\nReverse proxy stopped.")
 
 if __name__ == '__main__':
     main()
@@ -4,36 +4,176 @@ Simple HTTP server for serving Vlinder .ht files
 Supports CORS for mobile app access
 """
 
+import hashlib
 import http.server
-import socketserver
 import os
+import re
 import sys
+import threading
+import time
+import urllib.parse
 from pathlib import Path
 
+from server_common import KeepAliveMixin
+
 # Default port (internal - accessed via reverse proxy)
 PORT = 8002
 
 # Get assets directory
 ASSETS_DIR = Path(__file__).parent / 'assets'
 
-class CORSRequestHandler(http.server.SimpleHTTPRequestHandler):
+# CORS preflight response, sent verbatim
+_OPTIONS_RESPONSE = (
+    b'HTTP/1.1 200 OK\r\n'
+    b'Access-Control-Allow-Origin: *\r\n'
+    b'Access-Control-Allow-Methods: GET, OPTIONS\r\n'
+    b'Access-Control-Allow-Headers: Content-Type\r\n'
+    b'Cache-Control: no-cache, no-store, must-revalidate\r\n'
+    b'Content-Length: 0\r\n'
+    b'\r\n'
+)
+
+# How often the asset cache checks the assets directory for changes (seconds)
+ASSET_POLL_INTERVAL = 1.0
+
+# Length of the content-hash prefix used in versioned asset URLs
+ASSET_HASH_LENGTH = 16
+
+# Versioned asset URLs: /assets/<content-hash-prefix>/<file name>
+_VERSIONED_PATH = re.compile(r'assets/([0-9a-f]{%d})/([^/]+)' % ASSET_HASH_LENGTH)
+
+# Cache-Control for versioned URLs (content can never change) and plain
+# names (may change at any time, so always revalidate with the ETag)
+_CACHE_IMMUTABLE = 'public, max-age=31536000, immutable'
+_CACHE_REVALIDATE = 'no-cache'
+
+# File name -> ((mtime_ns, size), contents, ETag) for files in ASSETS_DIR
+_ASSET_CACHE = {}
+
+def _refresh_asset_cache():
+    """Load new or changed asset files and drop deleted ones"""
+    seen = set()
+    with os.scandir(ASSETS_DIR) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            seen.add(entry.name)
+            st = entry.stat()
+            key = (st.st_mtime_ns, st.st_size)
+            cached = _ASSET_CACHE.get(entry.name)
+            if cached is not None and cached[0] == key:
+                continue
+            with open(entry.path, 'rb') as f:
+                data = f.read()
+            if len(data) != st.st_size:
+                # Still being written - keep the old entry until the next poll
+                continue
+            etag = '"' + hashlib.sha256(data).hexdigest() + '"'
+            _ASSET_CACHE[entry.name] = (key, data, etag)
+    
+    for name in list(_ASSET_CACHE):
+        if name not in seen:
+            del _ASSET_CACHE[name]
+
+def _watch_assets():
+    """Background thread that keeps the asset cache in sync with disk"""
+    while True:
+        time.sleep(ASSET_POLL_INTERVAL)
+        try:
+            _refresh_asset_cache()
+        except OSError as e:
+            print(f"Error refreshing asset cache: {e}", file=sys.stderr)
+
+class CORSRequestHandler(KeepAliveMixin, http.server.SimpleHTTPRequestHandler):
     """HTTP request handler with CORS support"""
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=str(ASSETS_DIR), **kwargs)
     
     def end_headers(self):
-        """Add CORS headers to all responses"""
+        """Add CORS headers to all responses served from disk"""
+        self._send_cors_headers()
+        self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+        super().end_headers()
+    
+    def _send_cors_headers(self):
+        """Send CORS headers"""
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+    
+    def do_GET(self):
+        """Serve cached assets from memory, anything else from disk"""
+        if not self._send_cached_asset():
+            super().do_GET()
+    
+    def do_HEAD(self):
+        """Serve cached asset headers from memory, anything else from disk"""
+        if not self._send_cached_asset(include_body=False):
+            super().do_HEAD()
+    
+    def _send_cached_asset(self, include_body=True):
+        """Send a cached asset, honouring If-None-Match
+        
+        Plain names (/rules.ht) must be revalidated on every use; versioned
+        URLs (/assets/<hash>/rules.ht) can be cached by clients forever.
+        Returns False if the path isn't a cached asset (or a stale version).
+        """
+        name = urllib.parse.unquote(self.path.split('?', 1)[0].split('#', 1)[0]).lstrip('/')
+        versioned = _VERSIONED_PATH.fullmatch(name)
+        if versioned:
+            version, name = versioned.groups()
+        cached = _ASSET_CACHE.get(name)
+        if cached is None:
+            return False
+        
+        (mtime_ns, _), data, etag = cached
+        if versioned:
+            if etag[1:1 + ASSET_HASH_LENGTH] != version:
+                return False
+            cache_control = _CACHE_IMMUTABLE
+        else:
+            cache_control = _CACHE_REVALIDATE
+        
+        # Client already has this version
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            if '*' in tags or etag in tags or 'W/' + etag in tags:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', cache_control)
+                self._send_cors_headers()
+                super().end_headers()
+                return True
+        
+        self.send_response(200)
+        self.send_header('Content-type', self.guess_type(name))
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Last-Modified', self.date_time_string(mtime_ns // 1_000_000_000))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', cache_control)
+        if not versioned:
+            # Point clients at the immutable URL for this exact content
+            version = etag[1:1 + ASSET_HASH_LENGTH]
+            self.send_header('Content-Location', f"/assets/{version}/{urllib.parse.quote(name)}")
+        self._send_cors_headers()
         super().end_headers()
+        if include_body:
+            self.wfile.write(data)
+        return True
+    
+    def copyfile(self, source, outputfile):
+        """Send file bodies with sendfile() so they never pass through Python"""
+        # Headers are already flushed and wfile is unbuffered, so writing
+        # straight to the socket keeps the response in order. Non-file
+        # sources (directory listings) fall back to plain send().
+        self.connection.sendfile(source)
     
     def do_OPTIONS(self):
         """Handle OPTIONS requests for CORS preflight"""
-        self.send_response(200)
-        self.end_headers()
+        self.log_request(200)
+        self.wfile.write(_OPTIONS_RESPONSE)
     
     def log_message(self, format, *args):
         """Custom log format"""
@@ -56,8 +196,12 @@ def main():
         print(f"Warning: No asset files found in {ASSETS_DIR}")
         print(f"Expected files: ui.yaml, schema.yaml, workflows.yaml, rules.ht, actions.ht")
     
-    # Create server
-    with socketserver.TCPServer(("", PORT), CORSRequestHandler) as httpd:
+    # Load assets into memory and keep them in sync with disk
+    _refresh_asset_cache()
+    threading.Thread(target=_watch_assets, name='asset-watcher', daemon=True).start()
+    
+    # Create server (one thread per connection)
+    with http.server.ThreadingHTTPServer(("", PORT), CORSRequestHandler) as httpd:
         print(f"Vlinder Asset Server")
         print(f"===================")
         print(f"Serving assets from: {ASSETS_DIR}")
@@ -0,0 +1,114 @@
+"""
+Shared helpers for the Vlinder development servers
+Used by serve_assets.py, log_server.py and reverse_proxy.py
+"""
+
+import os
+import signal
+import sys
+import threading
+
+# Request bodies are read into a reusable per-thread buffer of at least
+# BODY_BUFFER_SIZE; one that grew past MAX_BODY_BUFFER_SIZE is shrunk again
+BODY_BUFFER_SIZE = 128 * 1024
+MAX_BODY_BUFFER_SIZE = 4 << 20
+_BUFFERS = threading.local()
+
+def read_into_buffer(rfile, length):
+    """Read length bytes into this thread's reusable buffer
+    
+    Returns a memoryview over the buffer, valid until the next call on the
+    same thread.
+    """
+    buffer = getattr(_BUFFERS, 'body', None)
+    if buffer is None or len(buffer) < length:
+        buffer = _BUFFERS.body = bytearray(max(length, BODY_BUFFER_SIZE))
+    elif len(buffer) > MAX_BODY_BUFFER_SIZE and length <= BODY_BUFFER_SIZE:
+        # Give back memory from an unusually large request
+        buffer = _BUFFERS.body = bytearray(BODY_BUFFER_SIZE)
+    
+    view = memoryview(buffer)
+    received = 0
+    while received < length:
+        n = rfile.readinto(view[received:length])
+        if not n:
+            break
+        received += n
+    return view[:received]
+
+# Timeout for requests from the reverse proxy to its backends (seconds)
+BACKEND_TIMEOUT = 10
+
+# Default number of worker processes per server. Each has its own GIL, and
+# the kernel spreads connections on the shared listening socket across them
+DEFAULT_WORKERS = (os.cpu_count() or 1) if hasattr(os, 'fork') else 1
+
+# How long shutdown waits for requests already in progress (seconds)
+SHUTDOWN_GRACE = 5
+
+# Kept-alive client connections idle for this long are closed (seconds)
+KEEPALIVE_TIMEOUT = 30
+
+class KeepAliveMixin:
+    """Connection settings shared by the request handlers of all servers"""
+    
+    # Keep connections open between requests. Every response sets
+    # Content-Length, and ThreadingHTTPServer gives each connection its own
+    # thread, so an idle client only ties up that thread until the timeout.
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+    
+    # Headers and body go out in separate writes; with Nagle enabled the
+    # second one can stall on a kept-alive connection waiting for an ACK
+    disable_nagle_algorithm = True
+
+class RequestTracker:
+    """Counts requests in progress so shutdown can let them finish"""
+    
+    def __init__(self):
+        self._active = 0
+        self._idle = threading.Condition()
+    
+    def __enter__(self):
+        with self._idle:
+            self._active += 1
+    
+    def __exit__(self, *exc_info):
+        with self._idle:
+            self._active -= 1
+            if not self._active:
+                self._idle.notify_all()
+    
+    def wait_idle(self, timeout):
+        """Wait up to timeout seconds for every request in progress to finish"""
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._active, timeout)
+
+def fork_workers(count):
+    """Fork count - 1 extra processes that accept on the same listening socket
+    
+    Returns the child pids in the parent and None in a child.
+    """
+    sys.stdout.flush()  # don't duplicate buffered output into the children
+    children = []
+    for _ in range(count - 1):
+        pid = os.fork()
+        if pid == 0:
+            # Workers stop when the parent forwards SIGTERM, not on Ctrl+C
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            return None
+        children.append(pid)
+    return children
+
+def stop_workers(children):
+    """Terminate and reap worker processes"""
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in children:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass